@@ -0,0 +1,18 @@
+import orjson
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
+
+from .config import DATABASE_URL
+
+# DATABASE_URL must use an async driver, e.g. postgresql+asyncpg://...
+# orjson handles the JSON columns (ai_feedback, topics_summary, ...)
+engine = create_async_engine(
+    DATABASE_URL,
+    json_serializer=lambda value: orjson.dumps(value).decode(),
+    json_deserializer=orjson.loads
+)
+SessionLocal = async_sessionmaker(bind=engine, autoflush=False, expire_on_commit=False)
+
+# Dependency to get DB Session
+async def get_db():
+    async with SessionLocal() as db:
+        yield db
@@ -1,4 +1,5 @@
-from sqlalchemy import Column, Integer, Float, String, DateTime, ForeignKey, JSON, Boolean
+from sqlalchemy import Column, Integer, Float, String, DateTime, ForeignKey, Boolean, Text, Index
+from sqlalchemy.dialects.postgresql import JSONB
 from sqlalchemy.orm import relationship
 from sqlalchemy.ext.declarative import declarative_base
 from datetime import datetime
@@ -31,15 +32,25 @@ class TestResult(Base):
     test_id = Column(Integer, ForeignKey("tests.id"))
     score = Column(Float)
     completed_at = Column(DateTime, default=datetime.utcnow)
-    ai_feedback = Column(JSON)  # Structured feedback from Groq
+    ai_feedback = Column(JSONB)  # Structured feedback from Groq
+    # Groq analysis text, kept apart so listings skip ai_feedback. Existing
+    # databases need: ALTER TABLE test_results ADD COLUMN ai_analysis text
+    ai_analysis = Column(Text)
     questions = relationship("TestQuestion", back_populates="test_result")
     
     # Detailed analytics
     total_questions = Column(Integer)
     correct_answers = Column(Integer)
-    topics_summary = Column(JSON)  # Performance by topic
+    topics_summary = Column(JSONB)  # Performance by topic
     time_taken = Column(Integer)  # Time taken in seconds
 
+    # Serves the per-student "latest tests" lookups without a sort, and
+    # topic-filtered queries on topics_summary
+    __table_args__ = (
+        Index("ix_testresult_student_completed", student_id, completed_at.desc()),
+        Index("ix_testresult_topics_gin", topics_summary, postgresql_using="gin"),
+    )
+
 class StudentAnalytics(Base):
     __tablename__ = "student_analytics"
     id = Column(Integer, primary_key=True, index=True)
@@ -47,8 +58,8 @@ class StudentAnalytics(Base):
     total_flashcards_viewed = Column(Integer, default=0)
     total_tests_taken = Column(Integer, default=0)
     average_test_score = Column(Float, default=0.0)
-    weak_topics = Column(JSON)  # List of topics needing improvement
-    strong_topics = Column(JSON)  # List of mastered topics
+    weak_topics = Column(JSONB)  # List of topics needing improvement
+    strong_topics = Column(JSONB)  # List of mastered topics
     learning_streak = Column(Integer, default=0)  # Consecutive days of activity
     last_activity = Column(DateTime, default=datetime.utcnow)
-    historical_performance = Column(JSON)  # Monthly/weekly performance trends
+    historical_performance = Column(JSONB)  # Monthly/weekly performance trends
@@ -1,21 +1,45 @@
 from fastapi import APIRouter, Depends, HTTPException
-from sqlalchemy.orm import Session
-from typing import List, Dict
-import pandas as pd
+from fastapi.responses import StreamingResponse
+from sqlalchemy import select, insert, update, func, case, cast, Date, Text
+from sqlalchemy.dialects.postgresql import ARRAY, insert as pg_insert
+from sqlalchemy.ext.asyncio import AsyncSession
+from typing import List, Dict, Optional
+from collections import defaultdict
+from functools import lru_cache
+import asyncio
+import logging
 import plotly.express as px
-from groq import Groq
+from groq import AsyncGroq
 from datetime import datetime, timedelta
-import json
-from pydantic import BaseModel
+import orjson
+from pydantic import BaseModel, ConfigDict
 
 from ..models.analytics import FlashcardView, TestResult, TestQuestion, StudentAnalytics
-from ..database import get_db
+from ..database import get_db, SessionLocal
 from ..config import GROQ_API_KEY
 
 router = APIRouter()
-groq_client = Groq(api_key=GROQ_API_KEY)
+logger = logging.getLogger(__name__)
+groq_client = AsyncGroq(api_key=GROQ_API_KEY)
+
+# Holds references to running analysis tasks so they aren't garbage collected
+analysis_tasks = set()
+
+# Fixed instructions sent as the system message so the provider can reuse its prompt cache
+SYSTEM_PROMPT = """As an educational AI assistant, analyze the test performance given by the user.
+
+Please provide:
+1. Specific strengths and weaknesses based on topic performance
+2. Detailed analysis of mistakes made, including common patterns
+3. Personalized study recommendations for each weak topic
+4. Time management feedback
+5. Suggested focus areas for immediate improvement
+
+Format the response in a clear, structured way that's encouraging but direct about areas needing improvement."""
 
 class QuestionSubmission(BaseModel):
+    model_config = ConfigDict(frozen=True, extra="forbid")
+
     question_text: str
     correct_answer: str
     student_answer: str
@@ -26,196 +50,309 @@ class TestSubmission(BaseModel):
     questions: List[QuestionSubmission]
     time_taken: int  # in seconds
 
-def generate_ai_insights(questions: List[QuestionSubmission], previous_results: List[TestResult] = None):
-    # Prepare detailed analysis of current test
-    correct_count = sum(1 for q in questions if q.student_answer == q.correct_answer)
-    total_questions = len(questions)
-    score = (correct_count / total_questions) * 100
-    
-    # Group questions by topic
-    topic_performance = {}
-    for q in questions:
-        if q.topic not in topic_performance:
-            topic_performance[q.topic] = {"correct": 0, "total": 0, "questions": []}
-        
-        is_correct = q.student_answer == q.correct_answer
-        topic_performance[q.topic]["correct"] += 1 if is_correct else 0
-        topic_performance[q.topic]["total"] += 1
-        topic_performance[q.topic]["questions"].append({
+def analyze_test(questions: List[QuestionSubmission], time_taken: int, prev_avg: Optional[float] = None):
+    # Compare each answer once and reuse the result everywhere below
+    correctness = [q.student_answer == q.correct_answer for q in questions]
+    correct_count = sum(correctness)
+
+    # Group questions by topic, building the TestQuestion rows for the bulk
+    # insert in the same pass
+    topic_performance = defaultdict(lambda: {"correct": 0, "total": 0, "questions": []})
+    question_rows = []
+    for q, is_correct in zip(questions, correctness):
+        topic = topic_performance[q.topic]
+        topic["correct"] += is_correct
+        topic["total"] += 1
+        topic["questions"].append({
             "question": q.question_text,
             "correct_answer": q.correct_answer,
             "student_answer": q.student_answer,
             "is_correct": is_correct
         })
+        question_rows.append({
+            "question_text": q.question_text,
+            "correct_answer": q.correct_answer,
+            "student_answer": q.student_answer,
+            "is_correct": is_correct,
+            "topic": q.topic,
+            "subtopic": q.subtopic
+        })
+
+    topic_performance = dict(topic_performance)
+
+    total_questions = len(questions)
+    score = (correct_count / total_questions) * 100
 
     # Prepare historical context if available
     historical_context = ""
-    if previous_results:
-        avg_score = sum(r.score for r in previous_results) / len(previous_results)
-        historical_context = f"\nHistorical context: Your average score is {avg_score:.1f}%. "
-        if score > avg_score:
+    if prev_avg is not None:
+        historical_context = f"\nHistorical context: Your average score is {prev_avg:.1f}%. "
+        if score > prev_avg:
             historical_context += "You performed above your usual average!"
         else:
             historical_context += "This score is below your usual performance."
 
-    # Create detailed prompt for Groq
-    prompt = f"""As an educational AI assistant, analyze this test performance:
-
-Overall Performance:
+    # Only the per-test figures go in the user message, the instructions are fixed
+    prompt = f"""Overall Performance:
 - Score: {score:.1f}%
 - Correct answers: {correct_count}/{total_questions}
-- Time taken: {questions[0].time_taken} seconds
+- Time taken: {time_taken} seconds
 
 Detailed Topic Analysis:
-{json.dumps(topic_performance, indent=2)}
-{historical_context}
+{orjson.dumps(topic_performance, option=orjson.OPT_INDENT_2).decode()}
+{historical_context}"""
 
-Please provide:
-1. Specific strengths and weaknesses based on topic performance
-2. Detailed analysis of mistakes made, including common patterns
-3. Personalized study recommendations for each weak topic
-4. Time management feedback
-5. Suggested focus areas for immediate improvement
-
-Format the response in a clear, structured way that's encouraging but direct about areas needing improvement."""
-
-    completion = groq_client.chat.completions.create(
-        model="mixtral-8x7b-32768",
-        messages=[{"role": "user", "content": prompt}],
-        temperature=0.7,
-        max_tokens=1000
-    )
-    
     return {
-        "analysis": completion.choices[0].message.content,
         "topic_performance": topic_performance,
         "score": score,
-        "time_taken": questions[0].time_taken
+        "correct_count": correct_count,
+        "time_taken": time_taken,
+        "question_rows": question_rows,
+        "prompt": prompt
     }
 
-@router.post("/submit-test/{student_id}/{test_id}")
-async def submit_test(
+async def generate_ai_insights(prompt: str):
+    # Stream the Groq analysis so the first tokens reach the client right away
+    stream = await groq_client.chat.completions.create(
+        model="mixtral-8x7b-32768",
+        messages=[
+            {"role": "system", "content": SYSTEM_PROMPT},
+            {"role": "user", "content": prompt}
+        ],
+        temperature=0.7,
+        max_tokens=1000,
+        stream=True
+    )
+    async for chunk in stream:
+        content = chunk.choices[0].delta.content
+        if content:
+            yield content
+
+def sse_event(data, event: Optional[str] = None) -> str:
+    # JSON-encode the payload so newlines in the analysis don't break SSE framing
+    message = f"data: {orjson.dumps(data).decode()}\n\n"
+    return f"event: {event}\n{message}" if event else message
+
+async def save_test_result(
+    db: AsyncSession,
     student_id: int,
     test_id: int,
-    test_submission: TestSubmission,
-    db: Session = Depends(get_db)
+    insights: Dict,
+    question_rows: List[Dict]
 ):
-    # Get previous test results for context
-    previous_results = db.query(TestResult).filter(
-        TestResult.student_id == student_id
-    ).order_by(TestResult.completed_at.desc()).limit(5).all()
-    
-    # Generate AI insights
-    insights = generate_ai_insights(test_submission.questions, previous_results)
-    
     # Create test result
     test_result = TestResult(
         student_id=student_id,
         test_id=test_id,
         score=insights["score"],
         ai_feedback=insights,
-        total_questions=len(test_submission.questions),
-        correct_answers=sum(1 for q in test_submission.questions if q.student_answer == q.correct_answer),
+        ai_analysis=insights["analysis"],
+        total_questions=len(question_rows),
+        correct_answers=insights["correct_count"],
         topics_summary=insights["topic_performance"],
-        time_taken=test_submission.time_taken
+        time_taken=insights["time_taken"]
     )
     db.add(test_result)
-    db.flush()  # Get test_result.id
+    await db.flush()  # Get test_result.id
     
-    # Add individual questions
-    for q in test_submission.questions:
-        question = TestQuestion(
-            test_result_id=test_result.id,
-            question_text=q.question_text,
-            correct_answer=q.correct_answer,
-            student_answer=q.student_answer,
-            is_correct=q.student_answer == q.correct_answer,
-            topic=q.topic,
-            subtopic=q.subtopic
-        )
-        db.add(question)
-    
-    # Update student analytics
-    analytics = db.query(StudentAnalytics).filter(
-        StudentAnalytics.student_id == student_id
-    ).first()
-    
-    if not analytics:
-        analytics = StudentAnalytics(student_id=student_id)
-        db.add(analytics)
-    
-    analytics.total_tests_taken += 1
-    analytics.last_activity = datetime.utcnow()
-    
-    # Update average score
-    all_scores = [r.score for r in previous_results] + [insights["score"]]
-    analytics.average_test_score = sum(all_scores) / len(all_scores)
+    # Add individual questions in a single batched INSERT
+    for row in question_rows:
+        row["test_result_id"] = test_result.id
+    await db.execute(insert(TestQuestion), question_rows)
     
     # Update weak and strong topics
-    topic_strengths = {}
+    weak_topics, strong_topics = [], []
     for topic, data in insights["topic_performance"].items():
         score = (data["correct"] / data["total"]) * 100
-        topic_strengths[topic] = score
+        if score < 70:
+            weak_topics.append(topic)
+        elif score >= 90:
+            strong_topics.append(topic)
+    
+    # Upsert student analytics in a single round-trip. The running average and
+    # the learning streak are computed in SQL against the existing row, so
+    # overlapping submissions for the same student don't overwrite each other.
+    now = datetime.utcnow()
+    today = now.date()
+    prev_day = cast(StudentAnalytics.last_activity, Date)
+    stmt = pg_insert(StudentAnalytics).values(
+        student_id=student_id,
+        total_tests_taken=1,
+        average_test_score=insights["score"],
+        weak_topics=weak_topics,
+        strong_topics=strong_topics,
+        learning_streak=1,
+        last_activity=now
+    )
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[StudentAnalytics.student_id],
+        set_={
+            "total_tests_taken": StudentAnalytics.total_tests_taken + 1,
+            "average_test_score": (
+                StudentAnalytics.average_test_score * StudentAnalytics.total_tests_taken
+                + stmt.excluded.average_test_score
+            ) / (StudentAnalytics.total_tests_taken + 1),
+            "weak_topics": stmt.excluded.weak_topics,
+            "strong_topics": stmt.excluded.strong_topics,
+            "learning_streak": case(
+                (prev_day == today - timedelta(days=1), StudentAnalytics.learning_streak + 1),
+                (prev_day == today, StudentAnalytics.learning_streak),  # Already active today
+                else_=1
+            ),
+            "last_activity": stmt.excluded.last_activity
+        }
+    ).returning(
+        StudentAnalytics.total_tests_taken,
+        StudentAnalytics.average_test_score,
+        StudentAnalytics.learning_streak,
+        StudentAnalytics.weak_topics,
+        StudentAnalytics.strong_topics
+    )
+    analytics = (await db.execute(stmt)).one()
     
-    analytics.weak_topics = [topic for topic, score in topic_strengths.items() if score < 70]
-    analytics.strong_topics = [topic for topic, score in topic_strengths.items() if score >= 90]
+    await db.commit()
     
-    # Update learning streak
-    if analytics.last_activity and (datetime.utcnow() - analytics.last_activity) <= timedelta(days=1):
-        analytics.learning_streak += 1
+    return test_result.id, {
+        "total_tests": analytics.total_tests_taken,
+        "average_score": analytics.average_test_score,
+        "learning_streak": analytics.learning_streak,
+        "weak_topics": analytics.weak_topics,
+        "strong_topics": analytics.strong_topics
+    }
+
+async def complete_analysis(test_result_id: int, insights: Dict, prompt: str, queue: asyncio.Queue):
+    # Runs independently of the client connection: the analysis is streamed into
+    # the queue and stored on the test result once complete. Errors are passed
+    # on to the queue, and None marks the end of the stream.
+    try:
+        chunks = []
+        async for content in generate_ai_insights(prompt):
+            chunks.append(content)
+            queue.put_nowait(content)
+        insights["analysis"] = "".join(chunks)
+        
+        async with SessionLocal() as db:
+            await db.execute(update(TestResult).where(
+                TestResult.id == test_result_id
+            ).values(
+                ai_analysis=insights["analysis"],
+                ai_feedback=insights
+            ))
+            await db.commit()
+    except Exception as error:
+        # The client may already be gone, so the log is the only record of the failure
+        logger.exception("Failed to complete AI analysis for test result %s", test_result_id)
+        queue.put_nowait(error)
     else:
-        analytics.learning_streak = 1
+        queue.put_nowait(None)
+
+@router.post("/submit-test/{student_id}/{test_id}")
+async def submit_test(
+    student_id: int,
+    test_id: int,
+    test_submission: TestSubmission,
+    db: AsyncSession = Depends(get_db)
+):
+    # Get the student's historical average for the prompt's context
+    result = await db.execute(select(func.avg(TestResult.score)).where(
+        TestResult.student_id == student_id
+    ))
+    prev_avg = result.scalar()
     
-    db.commit()
+    insights = analyze_test(test_submission.questions, test_submission.time_taken, prev_avg)
+    question_rows = insights.pop("question_rows")
+    prompt = insights.pop("prompt")
     
-    return {
-        "status": "success",
-        "insights": insights,
-        "analytics_summary": {
-            "total_tests": analytics.total_tests_taken,
-            "average_score": analytics.average_test_score,
-            "learning_streak": analytics.learning_streak,
-            "weak_topics": analytics.weak_topics,
-            "strong_topics": analytics.strong_topics
-        }
-    }
+    # Persist the submission up front so it doesn't depend on the client staying
+    # connected; the analysis text is filled in once generation finishes
+    insights["analysis"] = None
+    test_result_id, analytics_summary = await save_test_result(
+        db, student_id, test_id, insights, question_rows
+    )
+    
+    queue = asyncio.Queue()
+    task = asyncio.create_task(complete_analysis(test_result_id, insights, prompt, queue))
+    analysis_tasks.add(task)
+    task.add_done_callback(analysis_tasks.discard)
+    
+    async def event_stream():
+        # Forward the AI insights as they are generated, then the final summary
+        while (item := await queue.get()) is not None:
+            if isinstance(item, Exception):
+                yield sse_event({"detail": "Failed to generate AI insights"}, event="error")
+                return
+            yield sse_event(item)
+        yield sse_event({
+            "status": "success",
+            "insights": insights,
+            "analytics_summary": analytics_summary
+        }, event="result")
+    
+    return StreamingResponse(event_stream(), media_type="text/event-stream")
+
+# Keyed only on the plotted (completed_at, score) points: a new submission changes
+# the points and so misses the cache, while stale entries age out of the LRU.
+# The cache is per process; multi-worker deployments each keep their own.
+@lru_cache(maxsize=1024)
+def performance_chart_json(points: tuple) -> str:
+    fig = px.line(
+        x=[completed_at for completed_at, _ in points],
+        y=[score for _, score in points],
+        title="Test Score Progression",
+        labels={"x": "Date", "y": "Score (%)"}
+    )
+    return fig.to_json()
 
 @router.get("/student-performance/{student_id}")
 async def get_student_performance(
     student_id: int,
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_db)
 ):
-    analytics = db.query(StudentAnalytics).filter(
+    result = await db.execute(select(StudentAnalytics).where(
         StudentAnalytics.student_id == student_id
-    ).first()
+    ))
+    analytics = result.scalars().first()
     
     if not analytics:
         raise HTTPException(status_code=404, detail="Student analytics not found")
     
-    # Get recent test results with details
-    recent_tests = db.query(TestResult).filter(
+    # Get recent test results with details. Topic names are extracted from the
+    # JSONB summary in the database so the per-question breakdown isn't fetched.
+    # JSONB doesn't keep submission order, so topics are returned alphabetically.
+    # The subquery is correlated so each row only reads its own topics_summary.
+    topic = func.jsonb_object_keys(TestResult.topics_summary).label("topic")
+    topics = func.array(
+        select(topic).correlate(TestResult).order_by(topic).scalar_subquery(),
+        type_=ARRAY(Text)
+    )
+    result = await db.execute(select(
+        TestResult.completed_at,
+        TestResult.score,
+        topics.label("topics"),
+        TestResult.time_taken,
+        # Tests saved before ai_analysis existed only have the text in ai_feedback
+        func.coalesce(
+            TestResult.ai_analysis,
+            TestResult.ai_feedback["analysis"].astext
+        ).label("ai_analysis")
+    ).where(
         TestResult.student_id == student_id
-    ).order_by(TestResult.completed_at.desc()).limit(10).all()
+    ).order_by(TestResult.completed_at.desc()).limit(10))
+    recent_tests = result.all()
     
     # Create performance chart
     test_data = [{
         "date": test.completed_at,
         "score": test.score,
-        "topics": list(test.topics_summary.keys()),
+        "topics": test.topics,
         "time_taken": test.time_taken,
-        "insights": test.ai_feedback["analysis"]
+        "insights": test.ai_analysis
     } for test in recent_tests]
     
     if test_data:
-        df = pd.DataFrame(test_data)
-        fig = px.line(
-            df,
-            x="date",
-            y="score",
-            title="Test Score Progression",
-            labels={"date": "Date", "score": "Score (%)"}
+        performance_chart = performance_chart_json(
+            tuple((test.completed_at, test.score) for test in recent_tests)
         )
-        performance_chart = fig.to_json()
     else:
         performance_chart = None
     